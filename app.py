@@ -4,37 +4,87 @@ app.py: Streamlit app entry point for sales dashboard.
 import streamlit as st
 import logging
 import locale
+import os
 import time
 import sqlite3
+import threading
+import hashlib
 import bcrypt
 from loader import load_data
-from data_prep import prepare_data
-from metrics import compute_kpis, compute_advanced_metrics
-from charts import line_chart, bar_chart, heatmap_chart, pie_chart, map_view, forecast_chart
+from data_prep import prepare_data, PREPARE_VERSION
+from metrics import (compute_kpis, compute_advanced_metrics, daily_aggregates, build_yoy,
+                     build_segmentation, build_churn, build_product_summary)
+from charts import line_chart, bar_chart, heatmap_chart, pie_chart, map_view, forecast_chart, extract_uk_postcode_vec
 import config
 
 DB_PATH = 'users.db'
-
+BCRYPT_ROUNDS = getattr(config, 'BCRYPT_ROUNDS', 10)
+
+# Auth queries. Reusing the same SQL text on the shared connection lets sqlite3's
+# statement cache hand back the already-prepared statement instead of re-parsing it.
+SQL_REGISTER_USER = ('INSERT INTO users (username, password_hash, status, is_admin) VALUES (?, ?, ?, ?) '
+                     'ON CONFLICT(username) DO NOTHING')
+SQL_UPSERT_ADMIN = ('INSERT INTO users (username, password_hash, status, is_admin) VALUES (?, ?, ?, 1) '
+                    'ON CONFLICT(username) DO UPDATE SET password_hash = excluded.password_hash, '
+                    'status = excluded.status, is_admin = 1')
+SQL_SET_PASSWORD = 'UPDATE users SET password_hash = ? WHERE username = ?'
+SQL_SET_ADMIN_PASSWORD = 'UPDATE users SET password_hash = ? WHERE is_admin = 1'
+SQL_SET_STATUS = 'UPDATE users SET status = ? WHERE username = ?'
+SQL_DELETE_USER = 'DELETE FROM users WHERE username = ?'
+SQL_GET_LOGIN = 'SELECT password_hash, status, is_admin FROM users WHERE username = ?'
+SQL_GET_PENDING = "SELECT username FROM users WHERE status = 'pending'"
+SQL_GET_APPROVED = "SELECT username FROM users WHERE status = 'approved' AND is_admin = 0"
+SQL_IS_ADMIN = 'SELECT is_admin FROM users WHERE username = ?'
+
+@st.cache_resource
+def get_conn():
+    """Return a single SQLite connection shared across reruns and sessions."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # WAL lets login reads proceed while an admin write is in progress
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    """Return the lock used to serialise writes on the shared connection."""
+    return threading.Lock()
+
+@st.cache_resource
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        username TEXT PRIMARY KEY,
-        password_hash TEXT
-        -- status column may be missing in old DBs
-    )''')
-    # Add status column if it doesn't exist
-    try:
-        c.execute('ALTER TABLE users ADD COLUMN status TEXT NOT NULL DEFAULT "pending"')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    # Add is_admin column if it doesn't exist
-    try:
-        c.execute('ALTER TABLE users ADD COLUMN is_admin INTEGER NOT NULL DEFAULT 0')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    conn.commit()
-    conn.close()
+    """Create or migrate the users schema, once per process; later calls are cache hits."""
+    c = get_conn().cursor()
+    with get_write_lock():
+        c.execute('''CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT
+            -- status column may be missing in old DBs
+        )''')
+        # Add status/is_admin columns if they don't exist, in a single transaction
+        cols = {row[1] for row in c.execute('PRAGMA table_info(users)')}
+        stmts = []
+        if 'status' not in cols:
+            stmts.append("ALTER TABLE users ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'")
+        if 'is_admin' not in cols:
+            stmts.append('ALTER TABLE users ADD COLUMN is_admin INTEGER NOT NULL DEFAULT 0')
+        if stmts:
+            c.execute('BEGIN')
+            try:
+                for stmt in stmts:
+                    c.execute(stmt)
+                c.execute('COMMIT')
+            except Exception:
+                # Never leave the shared autocommit connection inside an open transaction
+                c.execute('ROLLBACK')
+                raise
+        # Indexes for the status listings and the admin lookups (partial: only admin rows)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_status ON users(status)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_admin ON users(is_admin) WHERE is_admin = 1')
 
 # Admin credentials are now stored in the database.
 # To log in as admin, you need a user with is_admin=1, status='approved', and a set password.
@@ -54,48 +104,26 @@ def create_admin_user(username, password):
     Create an admin user with the given username and password.
     If the user already exists, update their password and set as admin/approved.
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-    c.execute('SELECT username FROM users WHERE username = ?', (username,))
-    if c.fetchone():
-        # Update existing user to admin and approved
-        c.execute('UPDATE users SET password_hash=?, status=?, is_admin=? WHERE username=?',
-                  (password_hash, 'approved', 1, username))
-    else:
-        # Insert new admin user
-        c.execute('INSERT INTO users (username, password_hash, status, is_admin) VALUES (?, ?, ?, ?)',
-                  (username, password_hash, 'approved', 1))
-    conn.commit()
-    conn.close()
+    password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    with get_write_lock():
+        # Insert, or promote the existing user to approved admin, in one statement
+        get_conn().execute(SQL_UPSERT_ADMIN, (username, password_hash, 'approved'))
 
 def register_user(username):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE username = ?', (username,))
-    if c.fetchone():
-        conn.close()
+    with get_write_lock():
+        # All new users are not admin by default, set password_hash to empty string for NOT NULL constraint
+        cur = get_conn().execute(SQL_REGISTER_USER, (username, '', 'pending', 0))
+    if cur.rowcount == 0:
         return False, 'Username already requested or exists.'
-    # All new users are not admin by default, set password_hash to empty string for NOT NULL constraint
-    c.execute('INSERT INTO users (username, password_hash, status, is_admin) VALUES (?, ?, ?, ?)', (username, '', 'pending', 0))
-    conn.commit()
-    conn.close()
     return True, 'Registration request submitted for admin approval.'
 
 def set_user_password(username, password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-    c.execute('UPDATE users SET password_hash = ? WHERE username = ?', (password_hash, username))
-    conn.commit()
-    conn.close()
+    password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    with get_write_lock():
+        get_conn().execute(SQL_SET_PASSWORD, (password_hash, username))
 
 def check_login_db(username, password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT password_hash, status, is_admin FROM users WHERE username = ?', (username,))
-    row = c.fetchone()
-    conn.close()
+    row = get_conn().execute(SQL_GET_LOGIN, (username,)).fetchone()
     if not row:
         return False
     password_hash, status, is_admin = row
@@ -103,69 +131,43 @@ def check_login_db(username, password):
     if (status == 'approved' or is_admin == 1) and (not password_hash or password_hash == ''):
         return "set_password"
     # Normal login
-    if (status == 'approved' or is_admin == 1) and password_hash and bcrypt.checkpw(password.encode(), password_hash):
-        return True
+    if (status == 'approved' or is_admin == 1) and password_hash:
+        pw_utf8 = password.encode()
+        hash_bytes = password_hash if isinstance(password_hash, bytes) else password_hash.encode()
+        if bcrypt.checkpw(pw_utf8, hash_bytes):
+            return True
     return False
 
 def get_pending_users():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE status = "pending"')
-    users = [row[0] for row in c.fetchall()]
-    conn.close()
-    return users
+    return [row[0] for row in get_conn().execute(SQL_GET_PENDING).fetchall()]
 
 def get_approved_users():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE status = "approved" AND is_admin = 0')
-    users = [row[0] for row in c.fetchall()]
-    conn.close()
-    return users
+    return [row[0] for row in get_conn().execute(SQL_GET_APPROVED).fetchall()]
 
 def delete_user(username):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('DELETE FROM users WHERE username = ?', (username,))
-    conn.commit()
-    conn.close()
+    with get_write_lock():
+        get_conn().execute(SQL_DELETE_USER, (username,))
 
 def reset_user_password(username, new_password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    password_hash = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt())
-    c.execute('UPDATE users SET password_hash = ? WHERE username = ?', (password_hash, username))
-    conn.commit()
-    conn.close()
+    password_hash = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    with get_write_lock():
+        get_conn().execute(SQL_SET_PASSWORD, (password_hash, username))
 
 def reset_admin_password(new_password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    password_hash = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt())
-    c.execute('UPDATE users SET password_hash = ? WHERE is_admin = 1', (password_hash,))
-    conn.commit()
-    conn.close()
+    password_hash = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    with get_write_lock():
+        get_conn().execute(SQL_SET_ADMIN_PASSWORD, (password_hash,))
 
 def approve_user(username):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE users SET status = "approved" WHERE username = ?', (username,))
-    conn.commit()
-    conn.close()
+    with get_write_lock():
+        get_conn().execute(SQL_SET_STATUS, ('approved', username))
 
 def reject_user(username):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE users SET status = "rejected" WHERE username = ?', (username,))
-    conn.commit()
-    conn.close()
+    with get_write_lock():
+        get_conn().execute(SQL_SET_STATUS, ('rejected', username))
 
 def is_admin_user(username):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT is_admin FROM users WHERE username = ?', (username,))
-    row = c.fetchone()
-    conn.close()
+    row = get_conn().execute(SQL_IS_ADMIN, (username,)).fetchone()
     return bool(row and row[0] == 1)
 
 def login_or_register():
@@ -249,7 +251,7 @@ def admin_panel():
                 if st.button(f"Delete {user}"):
                     delete_user(user)
                     st.warning(f"Deleted {user}")
-                    st.experimental_rerun()
+                    st.rerun()
             with col3:
                 with st.expander(f"Reset password for {user}"):
                     new_pw = st.text_input(f"New password for {user}", type="password", key=f"reset_{user}")
@@ -282,69 +284,295 @@ except locale.Error:
     except locale.Error:
         pass  # Fallback: do not crash if locale is not available
 
+_HIDE_SIDEBAR_CSS = """
+<style>
+[data-testid="stSidebar"] {display: none;}
+</style>
+"""
+
 def hide_sidebar():
     """
     Hides the Streamlit sidebar using custom CSS.
     """
-    st.markdown(
-        """
-        <style>
-        [data-testid="stSidebar"] {display: none;}
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
+    st.markdown(_HIDE_SIDEBAR_CSS, unsafe_allow_html=True)
+
+def _prune_upload_cache():
+    """Delete upload-cache files (uploads, their Parquet sidecars and stray .part files) last used
+    more than UPLOAD_CACHE_MAX_AGE_DAYS ago; each use refreshes the mtime with os.utime.
+    Sessions still listing a pruned upload are asked to re-upload it."""
+    cutoff = time.time() - getattr(config, 'UPLOAD_CACHE_MAX_AGE_DAYS', 30) * 86400
+    for entry in os.scandir(config.UPLOAD_CACHE_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError as e:
+            logging.warning(f"Could not prune upload cache file '{entry.path}': {e}")
+
+def _store_upload(data: bytes, name: str):
+    """Write uploaded bytes to the upload cache, named by their sha256, and return (digest, path).
+    Identical uploads from any session share one file. Storing a new file also prunes expired ones."""
+    ext = os.path.splitext(name)[1].lower()
+    digest = hashlib.sha256(data).hexdigest()
+    os.makedirs(config.UPLOAD_CACHE_DIR, exist_ok=True)
+    path = os.path.join(config.UPLOAD_CACHE_DIR, f"{digest}{ext}")
+    if not os.path.exists(path):
+        # Write then rename so another session never reads a half-written file
+        tmp_path = f"{path}.{threading.get_ident()}.part"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        _prune_upload_cache()
+    else:
+        # Re-uploaded: expiry counts from last use
+        os.utime(path)
+    return digest, path
+
+def _prepared_frame(file_path: str):
+    """prepare_data(load_data(file_path)), via a Parquet sidecar keyed by the stored upload's path
+    (which embeds its content hash) and by PREPARE_VERSION, so a change to prepare_data invalidates
+    sidecars written before it. The key does not use the mtime, which os.utime refreshes on each use.
+    Parquet keeps the categorical, datetime and downcast numeric dtypes, so later runs skip the Excel/CSV parse."""
+    import pandas as pd
+    sidecar = f"{file_path}.v{PREPARE_VERSION}.parquet"
+    if os.path.exists(sidecar):
+        try:
+            df = pd.read_parquet(sidecar)
+            os.utime(sidecar)
+            return df
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable prepared-data cache '{sidecar}': {e}")
+    df = prepare_data(load_data(file_path))
+    try:
+        tmp_path = f"{sidecar}.{threading.get_ident()}.part"
+        df.to_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, sidecar)
+    except Exception as e:
+        logging.warning(f"Could not write prepared-data cache '{sidecar}': {e}")
+    return df
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _load_and_prepare(file_path: str):
+    """Load and prepare a stored upload. The path embeds the content hash, so it is a cheap cache key."""
+    df = _prepared_frame(file_path)
+    # prepare_data returns rows sorted by Entered, so this is a sorted DatetimeIndex and the
+    # date filter becomes two binary searches. Undated rows can never fall inside a date range,
+    # so they are dropped here. The index is left unnamed to keep groupby('Entered') unambiguous.
+    df = df[df['Entered'].notna()]
+    return df.set_index('Entered', drop=False).rename_axis(None)
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _name_index(file_path: str, _df):
+    """Sorted row positions of each customer Name in _df, the _load_and_prepare(file_path) frame.
+    Keyed on the path alone (the leading underscore tells Streamlit not to hash the frame), and
+    held with cache_resource so a hit returns the dict without unpickling it; never mutate it."""
+    return _df.groupby('Name', observed=True).indices
+
+def _filter_options(df, col):
+    """Selectbox options for a categorical column: "All" followed by its categories, which
+    astype('category') already sorts. Not cached: hashing df costs far more than this lookup."""
+    return ["All"] + df[col].cat.categories.tolist()
+
+# Chart builders cached by Streamlit on their (hashed) inputs, shared across sessions
+@st.cache_data(max_entries=32, show_spinner=False)
+def _cached_line(aggregates, ma_col, freq):
+    return line_chart(None, ma_col=ma_col, freq=freq, aggregates=aggregates)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _cached_bar(df, by, value, top_n):
+    return bar_chart(df, by=by, value=value, top_n=top_n)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _cached_heatmap(df):
+    return heatmap_chart(df)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _cached_pie(df):
+    return pie_chart(df)
+
+def gbp(val):
+    try:
+        return locale.currency(val, symbol=True, grouping=True)
+    except Exception:
+        return f"£{val:,.2f}"
+
+# Sections with their own widgets run as fragments so interacting with them only reruns that section
+@st.fragment
+def render_trend_chart(aggregates):
+    # Visualizations
+    st.subheader("Sales Trends & Breakdown")
+    freq = st.radio("Time Granularity", options=["Daily", "Weekly", "Monthly"], horizontal=True, key="freq")
+    freq_map = {"Daily": 'D', "Weekly": 'W', "Monthly": 'M'}
+    t0 = time.time()
+    with st.spinner("Loading sales trend chart..."):
+        line_fig = _cached_line(aggregates, 7, freq_map[freq])
+    chart_msg = f"Sales trend chart loaded in {time.time() - t0:.2f} seconds"
+    st.plotly_chart(line_fig, use_container_width=True)
+    st.caption(chart_msg)
+
+@st.fragment
+def render_forecast(filtered_df, aggregates, chart_filters):
+    # Prophet forecast with confidence intervals (now under Nett Sales Over Time)
+    t0 = time.time()
+    st.subheader("Nett Sales Forecast")
+    st.markdown("""
+    <small>
+    <b>How is this forecast calculated?</b><br>
+    The forecast uses the Prophet model to predict daily Nett sales and unique order counts for the selected future period. Prophet is trained on your historical sales data, capturing trends and seasonality. The chart shows the predicted sales (blue line) and a confidence interval (shaded area). Forecasted KPIs below the chart are based on these predictions.
+    </small>
+    """, unsafe_allow_html=True)
+    with st.form("forecast_form"):
+        forecast_days = st.number_input("Forecast how many days into the future?", min_value=7, max_value=180, value=30, step=1, key="forecast_days")
+        run_forecast = st.form_submit_button("Run Forecast")
+    adv = None
+    forecast_key = f"forecast_{chart_filters['start_date']}_{chart_filters['end_date']}_{chart_filters['selected_name']}_{forecast_days}"
+    if run_forecast or ('last_forecast_key' in st.session_state and st.session_state['last_forecast_key'] == forecast_key and 'last_forecast_adv' in st.session_state):
+        with st.spinner("Running Prophet forecast, please wait..."):
+            if run_forecast or 'last_forecast_adv' not in st.session_state or st.session_state['last_forecast_key'] != forecast_key:
+                adv = compute_advanced_metrics(filtered_df, forecast_days=forecast_days, aggregates=aggregates)
+                st.session_state['last_forecast_key'] = forecast_key
+                st.session_state['last_forecast_adv'] = adv
+            else:
+                adv = st.session_state['last_forecast_adv']
+        st.plotly_chart(forecast_chart(adv), use_container_width=True)
+        st.write(f"Forecast chart and KPIs calculated in {time.time() - t0:.2f} seconds")
+        # After the forecast chart, show forecasted KPIs for the future date range
+        if adv.get('forecast') is not None and not adv['forecast'].empty and adv.get('forecast_orders') is not None and not adv['forecast_orders'].empty:
+            last_actual = filtered_df['Entered'].max()
+            forecast_future = adv['forecast'][adv['forecast'].index > last_actual]
+            forecast_lower = adv['forecast_lower'][adv['forecast_lower'].index > last_actual]
+            forecast_upper = adv['forecast_upper'][adv['forecast_upper'].index > last_actual]
+            forecast_orders_future = adv['forecast_orders'][adv['forecast_orders'].index > last_actual]
+            total_nett = forecast_future.sum()
+            total_orders = int(round(forecast_orders_future.sum()))
+            avg_order_value = total_nett / total_orders if total_orders else 0
+            avg_margin = filtered_df['Margin_%'].mean() if not filtered_df.empty else 0
+            kpi1f, kpi2f, kpi3f, kpi4f = st.columns(4)
+            kpi1f.metric("Forecasted Nett Sales", gbp(total_nett))
+            kpi2f.metric("Forecasted Orders", total_orders)
+            kpi3f.metric("Forecasted Avg Order Value", gbp(avg_order_value))
+            kpi4f.metric("Forecasted Avg Margin %", f"{avg_margin:.1f}%")
+            st.markdown(f"**Forecasted Nett Range:** {gbp(forecast_lower.sum())} - {gbp(forecast_upper.sum())}")
+
+def render_breakdown_charts(filtered_df):
+    col1, col2 = st.columns(2)
+    with col1:
+        t0 = time.time()
+        with st.spinner("Loading top descriptions chart..."):
+            bar_desc_fig = _cached_bar(filtered_df, 'Description', 'Nett', 10)
+        st.plotly_chart(bar_desc_fig, use_container_width=True)
+        st.caption(f"Top descriptions chart loaded in {time.time() - t0:.2f} seconds.")
+    with col2:
+        t0 = time.time()
+        with st.spinner("Loading top customers chart..."):
+            bar_name_fig = _cached_bar(filtered_df, 'Name', 'Nett', 10)
+        st.plotly_chart(bar_name_fig, use_container_width=True)
+        st.caption(f"Top customers chart loaded in {time.time() - t0:.2f} seconds.")
+
+    col3, col4 = st.columns(2)
+    with col3:
+        t0 = time.time()
+        with st.spinner("Loading heatmap..."):
+            heatmap_fig = _cached_heatmap(filtered_df)
+        st.plotly_chart(heatmap_fig, use_container_width=True)
+        st.caption(f"Heatmap loaded in {time.time() - t0:.2f} seconds.")
+    with col4:
+        t0 = time.time()
+        with st.spinner("Loading pie chart..."):
+            pie_fig = _cached_pie(filtered_df)
+        st.plotly_chart(pie_fig, use_container_width=True)
+        st.caption(f"Pie chart loaded in {time.time() - t0:.2f} seconds.")
+
+@st.fragment
+def render_map(filtered_df, uploaded_file):
+    # Map Visualisation Controls
+    st.subheader("Map: UK Sales by Address/Postcode Area")
+    from streamlit_folium import st_folium
+    col_map1, col_map2, col_map3 = st.columns([1,1,2])
+    with col_map1:
+        only_cached = st.checkbox("Only use cached postcodes (fast)", value=True, key="only_cached")
+    with col_map2:
+        top_n = st.number_input("Max postcodes to show", min_value=10, max_value=1000, value=1000, step=10, key="top_n")
+    with col_map3:
+        show_map = st.toggle("Show Map", value=st.session_state.get('show_map', False), key="show_map_toggle")
+    st.session_state['show_map'] = show_map
+    # Reset map if file changes
+    if uploaded_file is not None and (st.session_state.get('last_file') != uploaded_file.name):
+        st.session_state['show_map'] = False
+        st.session_state['last_file'] = uploaded_file.name
+        st.session_state.pop('last_map_filters', None)
+        st.session_state.pop('last_map', None)
+        st.session_state.pop('last_map_details', None)
+    if st.session_state['show_map']:
+        # Always regenerate the map for full interactivity
+        t0 = time.time()
+        with st.spinner("Generating map, this may take a moment..."):
+            # Extract postcodes once and share them between the map and its sales details
+            if 'Postcode' in filtered_df.columns:
+                postcodes = filtered_df['Postcode']
+            else:
+                postcodes = extract_uk_postcode_vec(filtered_df['Address'])
+            folium_map = map_view(filtered_df, only_cached=only_cached, top_n=top_n, postcodes=postcodes)
+            # Calculate sales details for the map
+            # Group by a postcode Series rather than copying the frame to attach a column;
+            # groupby drops the rows without a postcode.
+            map_df = filtered_df.groupby(postcodes.rename('Postcode')).agg({'Nett': 'sum', 'Order': 'count'}).reset_index()
+            total_nett = map_df['Nett'].sum()
+            total_orders = map_df['Order'].sum()
+            postcode_count = map_df['Postcode'].nunique()
+            map_details = {
+                'total_nett': total_nett,
+                'total_orders': total_orders,
+                'postcode_count': postcode_count
+            }
+            st.session_state['last_map_details'] = map_details
+        st.write(f"Map generated in {time.time() - t0:.2f} seconds")
+        if folium_map:
+            st_folium(folium_map, width=None, height=600)
+            if map_details:
+                st.info(f"Total Nett: £{map_details['total_nett']:,.2f} | Total Orders: {map_details['total_orders']} | Postcodes Shown: {map_details['postcode_count']}")
+            else:
+                st.warning("No map details available. Try toggling the map off and on again or changing a filter.")
 
 def main():
     init_db()
     # ensure_admin_user()  # This function is for development only. Do NOT use in production.
     # In production, create an admin user manually using create_admin_user or direct DB insert.
-    if not login_or_register():
+    # Once authenticated, reruns skip the login widgets and their DB/bcrypt checks entirely
+    if not st.session_state.get("authenticated", False) and not login_or_register():
         st.warning("Please log in to access the dashboard.")
         st.stop()
+    # Past this point the session is authenticated; snapshot the flags used below
+    is_admin = st.session_state.get("is_admin", False)
 
     # Sidebar visibility toggle
     if 'sidebar_hidden' not in st.session_state:
         st.session_state['sidebar_hidden'] = True
-    st.sidebar.checkbox("Hide sidebar after login", value=st.session_state['sidebar_hidden'], key='sidebar_hidden')
+    sidebar_hidden = st.sidebar.checkbox("Hide sidebar after login", value=st.session_state['sidebar_hidden'], key='sidebar_hidden')
 
     # Top row: Log Out and Admin Panel (if admin) - move to very top after login
-    show_admin_panel = False
-    if st.session_state.get("authenticated", False):
+    if is_admin:
         cols = st.columns([1, 1, 8])
         with cols[0]:
-            if st.button("Log Out"):
-                st.session_state.clear()
-                st.stop()
-        is_admin = st.session_state.get("is_admin", False)
+            log_out = st.button("Log Out")
         with cols[1]:
-            if is_admin:
-                if st.button("Admin Panel"):
-                    st.session_state["show_admin_panel"] = not st.session_state.get("show_admin_panel", False)
-        show_admin_panel = st.session_state.get("show_admin_panel", False)
-
-    # Sidebar hide logic (now optional)
-    if st.session_state.get("authenticated", False):
-        if st.session_state.get("sidebar_hidden", True):
-            st.markdown(
-                """
-                <style>
-                [data-testid=\"stSidebar\"] {display: none;}
-                </style>
-                """,
-                unsafe_allow_html=True,
-            )
+            if st.button("Admin Panel"):
+                st.session_state["show_admin_panel"] = not st.session_state.get("show_admin_panel", False)
+    else:
+        log_out = st.button("Log Out")
+    if log_out:
+        st.session_state.clear()
+        st.stop()
+    show_admin_panel = is_admin and st.session_state.get("show_admin_panel", False)
+
+    # Hide the sidebar when logged in (optional); injected once per rerun
+    if sidebar_hidden:
+        hide_sidebar()
 
     # Show admin panel in full width if toggled
     if show_admin_panel:
         admin_panel()
         st.stop()
 
-    # Hide the sidebar when logged in (optional)
-    authenticated = st.session_state.get("authenticated", False)
-    if authenticated and st.session_state.get("sidebar_hidden", True):
-        hide_sidebar()
-
     st.title("📊 Optimum Sales Dashboard")
     st.write("Upload an Annapurna Report 19: Sales by Job data file (.xlsx, .xls, .csv) to get started.")
 
@@ -353,71 +581,80 @@ def main():
         st.session_state['uploaded_files'] = {}
     uploaded_file = st.file_uploader("Choose a file", type=["xlsx", "xls", "csv"])
     if uploaded_file is not None:
-        st.session_state['uploaded_files'][uploaded_file.name] = uploaded_file.getvalue()
+        # Only the (digest, path) of each upload is kept in the session; the bytes live on disk
+        if st.session_state.get('last_upload_id') != uploaded_file.file_id:
+            st.session_state['uploaded_files'][uploaded_file.name] = _store_upload(uploaded_file.getvalue(), uploaded_file.name)
+            st.session_state['last_upload_id'] = uploaded_file.file_id
         st.session_state['last_file_name'] = uploaded_file.name
     file_options = list(st.session_state['uploaded_files'].keys())
-    selected_file = None
+    selected_path = None
     if file_options:
         default_idx = file_options.index(st.session_state.get('last_file_name', file_options[0])) if 'last_file_name' in st.session_state else 0
         selected_name = st.selectbox("Select a previously uploaded file", options=file_options, index=default_idx)
-        selected_file = st.session_state['uploaded_files'][selected_name]
+        _, selected_path = st.session_state['uploaded_files'][selected_name]
         st.session_state['last_file_name'] = selected_name
+        try:
+            # Mark the upload as used so _prune_upload_cache keeps it
+            os.utime(selected_path)
+        except FileNotFoundError:
+            # Expired from the upload cache (see _prune_upload_cache)
+            st.session_state['uploaded_files'].pop(selected_name)
+            st.session_state.pop('last_file_name', None)
+            st.session_state.pop('last_upload_id', None)  # let a still-attached upload be stored again
+            st.warning(f"'{selected_name}' has expired from the upload cache; please upload it again.")
+            selected_path = None
     df = None
-    if selected_file is not None:
-        import os
+    if selected_path is not None:
         import time
         try:
             import pandas as pd
-            import tempfile
+            import numpy as np
             t0 = time.time()
             with st.spinner("Loading and preparing data, please wait..."):
-                tmp_path = None
                 info_msg = st.empty()
-                try:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=selected_name[-5:]) as tmp:
-                        tmp.write(selected_file)
-                        tmp_path = tmp.name
-                    load_start = time.time()
-                    raw_df = load_data(tmp_path)
-                    load_time = time.time() - load_start
-                    info_msg.info(f"File loaded in {load_time:.2f} seconds")
-                    prep_start = time.time()
-                    df = prepare_data(raw_df)
-                    prep_time = time.time() - prep_start
-                    info_msg.info(f"Data prepared in {prep_time:.2f} seconds")
-                finally:
-                    if tmp_path and os.path.exists(tmp_path):
-                        os.remove(tmp_path)
+                df = _load_and_prepare(selected_path)
             info_msg.info(f"Loaded {len(df)} rows in {time.time() - t0:.2f} seconds.")
 
             # Date range, Name, and O/T filters side by side
-            filter_col1, filter_col2, filter_col3 = st.columns(3)
-            with filter_col1:
-                min_date = df['Entered'].min()
-                max_date = df['Entered'].max()
-                start_date, end_date = st.date_input(
-                    "Select date range (DD/MM/YYYY)",
-                    value=(min_date, max_date),
-                    min_value=min_date,
-                    max_value=max_date,
-                    format="DD/MM/YYYY"
-                )
-            with filter_col2:
-                names = df['Name'].dropna().unique().tolist()
-                selected_name = st.selectbox("Filter by Customer Name", options=["All"] + sorted(names), key="single_name")
-            with filter_col3:
-                ot_values = df['O/T'].dropna().unique().tolist()
-                selected_ot = st.selectbox("Filter by O/T", options=["All"] + sorted(ot_values), key="ot_filter")
-
-            # --- Apply filters in sequence to a fresh copy of df ---
-            filtered_df = df.copy()
-            filtered_df = filtered_df[(filtered_df['Entered'] >= pd.to_datetime(start_date)) & (filtered_df['Entered'] <= pd.to_datetime(end_date))]
+            with st.form("filters"):
+                filter_col1, filter_col2, filter_col3 = st.columns(3)
+                with filter_col1:
+                    min_date = df['Entered'].min()
+                    max_date = df['Entered'].max()
+                    start_date, end_date = st.date_input(
+                        "Select date range (DD/MM/YYYY)",
+                        value=(min_date, max_date),
+                        min_value=min_date,
+                        max_value=max_date,
+                        format="DD/MM/YYYY"
+                    )
+                with filter_col2:
+                    selected_name = st.selectbox("Filter by Customer Name", options=_filter_options(df, 'Name'), key="single_name")
+                with filter_col3:
+                    selected_ot = st.selectbox("Filter by O/T", options=_filter_options(df, 'O/T'), key="ot_filter")
+                st.form_submit_button("Apply filters")
+
+            # --- Apply filters in sequence; the date filter slices the sorted Entered index ---
+            lo = df.index.searchsorted(pd.to_datetime(start_date), side='left')
+            hi = df.index.searchsorted(pd.to_datetime(end_date), side='right')
             if selected_name != "All":
-                filtered_df = filtered_df[filtered_df['Name'] == selected_name]
+                # Customer rows are pre-grouped; keep those whose position lies in the date slice
+                rows = _name_index(selected_path, df).get(selected_name, np.empty(0, dtype=np.intp))
+                rows = rows[np.searchsorted(rows, lo):np.searchsorted(rows, hi)]
+                filtered_df = df.iloc[rows]
+            else:
+                filtered_df = df.iloc[lo:hi]
             if selected_ot != "All":
-                filtered_df = filtered_df[filtered_df['O/T'] == selected_ot]
+                # Compare the int category codes rather than the string values
+                ot_code = df['O/T'].cat.categories.get_loc(selected_ot)
+                filtered_df = filtered_df[filtered_df['O/T'].cat.codes.to_numpy() == ot_code]
+
+            # One per-day aggregation pass shared by the KPIs, trend chart and forecast
+            aggregates = daily_aggregates(filtered_df)
 
             # --- Chart and KPI caching ---
+            # Cheap identity of the current filter state, used to key the expander tables
+            filter_key = (selected_path, str(start_date), str(end_date), selected_name, selected_ot)
             chart_filters = {
                 'start_date': str(start_date),
                 'end_date': str(end_date),
@@ -434,17 +671,12 @@ def main():
                 'last_kpis' not in st.session_state
             ):
                 with st.spinner("Calculating KPIs..."):
-                    kpis = compute_kpis(filtered_df)
+                    kpis = compute_kpis(filtered_df, aggregates=aggregates)
                 st.session_state['last_kpi_filters'] = chart_filters.copy()
                 st.session_state['last_kpis'] = kpis
             else:
                 kpis = st.session_state['last_kpis']
             kpi1, kpi2, kpi3, kpi4, kpi5, kpi6 = st.columns(6)
-            def gbp(val):
-                try:
-                    return locale.currency(val, symbol=True, grouping=True)
-                except Exception:
-                    return f"£{val:,.2f}"
             kpi1.metric("Total Nett Sales", gbp(kpis['Total Nett Sales']))
             kpi2.metric("Total Orders", kpis['Total Orders'])
             kpi3.metric("Total Units Sold", int(kpis['Total Units Sold']))
@@ -452,196 +684,17 @@ def main():
             kpi5.metric("Avg Margin %", f"{kpis['Average Margin %']:.1f}%")
             kpi6.metric("Avg Turnaround (days)", f"{kpis['Average Turnaround']:.2f}")
 
-            # Visualizations
-            st.subheader("Sales Trends & Breakdown")
-            freq = st.radio("Time Granularity", options=["Daily", "Weekly", "Monthly"], horizontal=True, key="freq")
-            freq_map = {"Daily": 'D', "Weekly": 'W', "Monthly": 'M'}
-            # Line chart cache
-            line_chart_key = f"line_chart_{chart_filters['start_date']}_{chart_filters['end_date']}_{chart_filters['selected_name']}_{chart_filters['selected_ot']}_{freq}"
-            if (
-                'last_line_chart_key' not in st.session_state or
-                st.session_state['last_line_chart_key'] != line_chart_key or
-                'last_line_chart' not in st.session_state
-            ):
-                t0 = time.time()
-                with st.spinner("Loading sales trend chart..."):
-                    line_fig = line_chart(filtered_df, ma_col=7, freq=freq_map[freq])
-                st.session_state['last_line_chart_key'] = line_chart_key
-                st.session_state['last_line_chart'] = line_fig
-                chart_msg = f"Sales trend chart calculated in {time.time() - t0:.2f} seconds"
-            else:
-                line_fig = st.session_state['last_line_chart']
-                chart_msg = "Sales trend chart loaded from cache."
-            st.plotly_chart(line_fig, use_container_width=True)
-            st.caption(chart_msg)
-
-            # Prophet forecast with confidence intervals (now under Nett Sales Over Time)
-            t0 = time.time()
-            st.subheader("Nett Sales Forecast")
-            st.markdown("""
-            <small>
-            <b>How is this forecast calculated?</b><br>
-            The forecast uses the Prophet model to predict daily Nett sales and unique order counts for the selected future period. Prophet is trained on your historical sales data, capturing trends and seasonality. The chart shows the predicted sales (blue line) and a confidence interval (shaded area). Forecasted KPIs below the chart are based on these predictions.
-            </small>
-            """, unsafe_allow_html=True)
-            forecast_days = st.number_input("Forecast how many days into the future?", min_value=7, max_value=180, value=30, step=1, key="forecast_days")
-            run_forecast = st.button("Run Forecast")
-            adv = None
-            forecast_key = f"forecast_{chart_filters['start_date']}_{chart_filters['end_date']}_{chart_filters['selected_name']}_{forecast_days}"
-            if run_forecast or ('last_forecast_key' in st.session_state and st.session_state['last_forecast_key'] == forecast_key and 'last_forecast_adv' in st.session_state):
-                with st.spinner("Running Prophet forecast, please wait..."):
-                    if run_forecast or 'last_forecast_adv' not in st.session_state or st.session_state['last_forecast_key'] != forecast_key:
-                        adv = compute_advanced_metrics(filtered_df, forecast_days=forecast_days)
-                        st.session_state['last_forecast_key'] = forecast_key
-                        st.session_state['last_forecast_adv'] = adv
-                    else:
-                        adv = st.session_state['last_forecast_adv']
-                st.plotly_chart(forecast_chart(adv), use_container_width=True)
-                st.write(f"Forecast chart and KPIs calculated in {time.time() - t0:.2f} seconds")
-                # After the forecast chart, show forecasted KPIs for the future date range
-                if adv.get('forecast') is not None and not adv['forecast'].empty and adv.get('forecast_orders') is not None and not adv['forecast_orders'].empty:
-                    last_actual = filtered_df['Entered'].max()
-                    forecast_future = adv['forecast'][adv['forecast'].index > last_actual]
-                    forecast_lower = adv['forecast_lower'][adv['forecast_lower'].index > last_actual]
-                    forecast_upper = adv['forecast_upper'][adv['forecast_upper'].index > last_actual]
-                    forecast_orders_future = adv['forecast_orders'][adv['forecast_orders'].index > last_actual]
-                    total_nett = forecast_future.sum()
-                    total_orders = int(round(forecast_orders_future.sum()))
-                    avg_order_value = total_nett / total_orders if total_orders else 0
-                    avg_margin = filtered_df['Margin_%'].mean() if not filtered_df.empty else 0
-                    kpi1f, kpi2f, kpi3f, kpi4f = st.columns(4)
-                    kpi1f.metric("Forecasted Nett Sales", gbp(total_nett))
-                    kpi2f.metric("Forecasted Orders", total_orders)
-                    kpi3f.metric("Forecasted Avg Order Value", gbp(avg_order_value))
-                    kpi4f.metric("Forecasted Avg Margin %", f"{avg_margin:.1f}%")
-                    st.markdown(f"**Forecasted Nett Range:** {gbp(forecast_lower.sum())} - {gbp(forecast_upper.sum())}")
-
-            # Bar charts cache
-            bar_desc_key = f"bar_desc_{chart_filters['start_date']}_{chart_filters['end_date']}_{chart_filters['selected_name']}_{chart_filters['selected_ot']}"
-            bar_name_key = f"bar_name_{chart_filters['start_date']}_{chart_filters['end_date']}_{chart_filters['selected_name']}_{chart_filters['selected_ot']}"
-            col1, col2 = st.columns(2)
-            with col1:
-                if ('last_bar_desc_key' not in st.session_state or st.session_state['last_bar_desc_key'] != bar_desc_key or 'last_bar_desc_chart' not in st.session_state):
-                    t0 = time.time()
-                    with st.spinner("Loading top descriptions chart..."):
-                        bar_desc_fig = bar_chart(filtered_df, by='Description', value='Nett', top_n=10)
-                    st.session_state['last_bar_desc_key'] = bar_desc_key
-                    st.session_state['last_bar_desc_chart'] = bar_desc_fig
-                    bar_desc_msg = f"Top descriptions chart generated in {time.time() - t0:.2f} seconds."
-                else:
-                    bar_desc_fig = st.session_state['last_bar_desc_chart']
-                    bar_desc_msg = "Top descriptions chart loaded from cache."
-                st.plotly_chart(bar_desc_fig, use_container_width=True)
-                st.caption(bar_desc_msg)
-            with col2:
-                if ('last_bar_name_key' not in st.session_state or st.session_state['last_bar_name_key'] != bar_name_key or 'last_bar_name_chart' not in st.session_state):
-                    t0 = time.time()
-                    with st.spinner("Loading top customers chart..."):
-                        bar_name_fig = bar_chart(filtered_df, by='Name', value='Nett', top_n=10)
-                    st.session_state['last_bar_name_key'] = bar_name_key
-                    st.session_state['last_bar_name_chart'] = bar_name_fig
-                    bar_name_msg = f"Top customers chart generated in {time.time() - t0:.2f} seconds."
-                else:
-                    bar_name_fig = st.session_state['last_bar_name_chart']
-                    bar_name_msg = "Top customers chart loaded from cache."
-                st.plotly_chart(bar_name_fig, use_container_width=True)
-                st.caption(bar_name_msg)
-
-            # Heatmap and Pie chart cache
-            heatmap_key = f"heatmap_{chart_filters['start_date']}_{chart_filters['end_date']}_{chart_filters['selected_name']}_{chart_filters['selected_ot']}"
-            pie_key = f"pie_{chart_filters['start_date']}_{chart_filters['end_date']}_{chart_filters['selected_name']}_{chart_filters['selected_ot']}"
-            col3, col4 = st.columns(2)
-            with col3:
-                if ('last_heatmap_key' not in st.session_state or st.session_state['last_heatmap_key'] != heatmap_key or 'last_heatmap_chart' not in st.session_state):
-                    t0 = time.time()
-                    with st.spinner("Loading heatmap..."):
-                        heatmap_fig = heatmap_chart(filtered_df)
-                    st.session_state['last_heatmap_key'] = heatmap_key
-                    st.session_state['last_heatmap_chart'] = heatmap_fig
-                    heatmap_msg = f"Heatmap generated in {time.time() - t0:.2f} seconds."
-                else:
-                    heatmap_fig = st.session_state['last_heatmap_chart']
-                    heatmap_msg = "Heatmap loaded from cache."
-                st.plotly_chart(heatmap_fig, use_container_width=True)
-                st.caption(heatmap_msg)
-            with col4:
-                if ('last_pie_key' not in st.session_state or st.session_state['last_pie_key'] != pie_key or 'last_pie_chart' not in st.session_state):
-                    t0 = time.time()
-                    with st.spinner("Loading pie chart..."):
-                        pie_fig = pie_chart(filtered_df)
-                    st.session_state['last_pie_key'] = pie_key
-                    st.session_state['last_pie_chart'] = pie_fig
-                    pie_msg = f"Pie chart generated in {time.time() - t0:.2f} seconds."
-                else:
-                    pie_fig = st.session_state['last_pie_chart']
-                    pie_msg = "Pie chart loaded from cache."
-                st.plotly_chart(pie_fig, use_container_width=True)
-                st.caption(pie_msg)
-
-            # Map Visualisation Controls
-            st.subheader("Map: UK Sales by Address/Postcode Area")
-            from streamlit_folium import st_folium
-            col_map1, col_map2, col_map3 = st.columns([1,1,2])
-            with col_map1:
-                only_cached = st.checkbox("Only use cached postcodes (fast)", value=True, key="only_cached")
-            with col_map2:
-                top_n = st.number_input("Max postcodes to show", min_value=10, max_value=1000, value=1000, step=10, key="top_n")
-            with col_map3:
-                show_map = st.toggle("Show Map", value=st.session_state.get('show_map', False), key="show_map_toggle")
-            st.session_state['show_map'] = show_map
-            # Reset map if file changes
-            if uploaded_file is not None and (st.session_state.get('last_file') != uploaded_file.name):
-                st.session_state['show_map'] = False
-                st.session_state['last_file'] = uploaded_file.name
-                st.session_state.pop('last_map_filters', None)
-                st.session_state.pop('last_map', None)
-                st.session_state.pop('last_map_details', None)
-            # Map caching logic
-            map_filters = {
-                'name_filter': selected_name,
-                'date_range': (str(start_date), str(end_date)),
-                'only_cached': only_cached,
-                'top_n': top_n
-            }
-            if st.session_state['show_map']:
-                # Always regenerate the map for full interactivity
-                t0 = time.time()
-                with st.spinner("Generating map, this may take a moment..."):
-                    folium_map = map_view(filtered_df, only_cached=only_cached, top_n=top_n)
-                    # Calculate sales details for the map
-                    map_df = filtered_df.copy()
-                    if 'Postcode' not in map_df.columns:
-                        from charts import extract_uk_postcode
-                        map_df['Postcode'] = map_df['Address'].apply(extract_uk_postcode)
-                    map_df = map_df[map_df['Postcode'].notna()]
-                    map_df = map_df.groupby('Postcode').agg({'Nett': 'sum', 'Order': 'count'}).reset_index()
-                    total_nett = map_df['Nett'].sum()
-                    total_orders = map_df['Order'].sum()
-                    postcode_count = map_df['Postcode'].nunique()
-                    map_details = {
-                        'total_nett': total_nett,
-                        'total_orders': total_orders,
-                        'postcode_count': postcode_count
-                    }
-                    st.session_state['last_map_details'] = map_details
-                st.write(f"Map generated in {time.time() - t0:.2f} seconds")
-                if folium_map:
-                    st_folium(folium_map, width=None, height=600)
-                    if map_details:
-                        st.info(f"Total Nett: £{map_details['total_nett']:,.2f} | Total Orders: {map_details['total_orders']} | Postcodes Shown: {map_details['postcode_count']}")
-                    else:
-                        st.warning("No map details available. Try toggling the map off and on again or changing a filter.")
+            render_trend_chart(aggregates)
+            render_forecast(filtered_df, aggregates, chart_filters)
+            render_breakdown_charts(filtered_df)
+            render_map(filtered_df, uploaded_file)
 
             # --- Time Comparison: Year-over-Year (YoY) Comparison Chart ---
             with st.expander("Year-over-Year Comparison", expanded=False):
                 if st.button("Show YoY Chart"):
                     t0 = time.time()
-                    if filtered_df['Entered'].dt.year.nunique() > 1:
-                        yoy = filtered_df.copy()
-                        yoy['Year'] = yoy['Entered'].dt.year
-                        yoy['Month'] = yoy['Entered'].dt.month
-                        yoy_grouped = yoy.groupby(['Year', 'Month'])['Nett'].sum().reset_index()
-                        yoy_pivot = yoy_grouped.pivot(index='Month', columns='Year', values='Nett').sort_index()
+                    yoy_pivot = build_yoy(filter_key, filtered_df)
+                    if yoy_pivot.shape[1] > 1:
                         st.line_chart(yoy_pivot, use_container_width=True)
                     else:
                         st.info("Not enough years of data for YoY comparison.")
@@ -651,22 +704,17 @@ def main():
             with st.expander("Cumulative Nett Sales", expanded=False):
                 if st.button("Show Cumulative Chart"):
                     t0 = time.time()
-                    cum_df = filtered_df.sort_values('Entered')
-                    cum_df['Cumulative Nett'] = cum_df['Nett'].cumsum()
-                    st.line_chart(cum_df.set_index('Entered')['Cumulative Nett'], use_container_width=True)
+                    # Running total of the shared per-day Nett; one point per day
+                    cumulative = aggregates.loc[aggregates.index.notna(), 'Nett'].cumsum().rename('Cumulative Nett')
+                    st.line_chart(cumulative, use_container_width=True)
                     st.write(f"Cumulative chart calculated in {time.time() - t0:.2f} seconds")
 
             # --- Sales Funnel Visualization ---
             with st.expander("Sales Funnel Visualization", expanded=False):
                 if st.button("Show Funnel Chart"):
                     t0 = time.time()
-                    funnel_df = filtered_df.copy()
-                    funnel_df['Ordered'] = ~funnel_df['Order'].isna()
-                    funnel_df['SentFlag'] = ~funnel_df['Sent'].isna()
-                    funnel_counts = [
-                        funnel_df['Ordered'].sum(),
-                        funnel_df['SentFlag'].sum()
-                    ]
+                    # count() skips missing values, i.e. rows with an Order / a Sent date
+                    funnel_counts = [filtered_df['Order'].count(), filtered_df['Sent'].count()]
                     funnel_labels = ['Orders Entered', 'Orders Sent']
                     import plotly.graph_objects as go
                     funnel_trace = go.Funnel(
@@ -683,11 +731,7 @@ def main():
             with st.expander("Customer Segmentation", expanded=False):
                 if st.button("Show Segmentation Chart"):
                     t0 = time.time()
-                    seg_df = filtered_df.groupby('Name').agg({
-                        'Nett': 'sum',
-                        'Order': pd.Series.nunique
-                    }).rename(columns={'Order': 'Order Count'}).reset_index()
-                    seg_df['Segment'] = pd.qcut(seg_df['Nett'], 4, labels=['Low', 'Mid-Low', 'Mid-High', 'High'])
+                    seg_df = build_segmentation(filter_key, filtered_df)
                     import plotly.express as px
                     seg_fig = px.scatter(seg_df, x='Order Count', y='Nett', color='Segment', hover_name='Name',
                                          title='Customer Segmentation by Sales Volume and Frequency')
@@ -698,10 +742,7 @@ def main():
             with st.expander("Churn Prediction", expanded=False):
                 if st.button("Show Churn Table"):
                     t0 = time.time()
-                    last_date = filtered_df['Entered'].max()
-                    churn_df = filtered_df.groupby('Name')['Entered'].max().reset_index()
-                    churn_df['Days Since Last Order'] = (last_date - churn_df['Entered']).dt.days
-                    churned = churn_df[churn_df['Days Since Last Order'] > 90]
+                    churned = build_churn(filter_key, filtered_df)
                     st.write(f"Customers at risk of churn (>90 days since last order): {len(churned)}")
                     st.dataframe(churned[['Name', 'Days Since Last Order']])
                     st.write(f"Churn prediction calculated in {time.time() - t0:.2f} seconds")
@@ -710,17 +751,12 @@ def main():
             with st.expander("Product/Description Analysis", expanded=False):
                 if st.button("Show Product Analysis"):
                     t0 = time.time()
-                    prod_df = filtered_df.groupby('Description').agg({'Nett': 'sum', 'Order': pd.Series.nunique}).reset_index()
-                    prod_df['Nett'] = pd.to_numeric(prod_df['Nett'], errors='coerce')  # Ensure numeric dtype
-                    top_products = prod_df.nlargest(10, 'Nett')
-                    bottom_products = prod_df.nsmallest(10, 'Nett')
+                    top_products, bottom_products, prod_trend = build_product_summary(filter_key, filtered_df)
                     st.write("Top 10 Products by Nett Sales:")
                     st.dataframe(top_products)
                     st.write("Bottom 10 Products by Nett Sales:")
                     st.dataframe(bottom_products)
                     # Only show trends for top 5 products in the chart
-                    prod_trend = filtered_df[filtered_df['Description'].isin(top_products['Description'].head(5))]
-                    prod_trend = prod_trend.groupby(['Entered', 'Description'])['Nett'].sum().reset_index()
                     import plotly.express as px
                     prod_trend_fig = px.line(
                         prod_trend,
@@ -738,7 +774,7 @@ def main():
                 if st.button("Show Margin Analysis"):
                     t0 = time.time()
                     margin_threshold = st.slider("Highlight orders with margin below (%)", min_value=0, max_value=100, value=20)
-                    low_margin_df = filtered_df[filtered_df['Margin_%'] < margin_threshold]
+                    low_margin_df = filtered_df[filtered_df['Margin_%'].to_numpy() < margin_threshold]
                     st.write(f"Orders with margin below {margin_threshold}%: {len(low_margin_df)}")
                     st.dataframe(low_margin_df[['Order', 'Name', 'Nett', 'Margin_%']])
                     import plotly.express as px
@@ -750,7 +786,7 @@ def main():
             with st.expander("Advanced Metrics", expanded=False):
                 if st.button("Show Advanced Metrics"):
                     t0 = time.time()
-                    adv = compute_advanced_metrics(filtered_df, forecast_days=forecast_days)
+                    adv = compute_advanced_metrics(filtered_df, forecast_days=st.session_state.get('forecast_days', 30), aggregates=aggregates)
                     st.write(f"Advanced metrics calculated in {time.time() - t0:.2f} seconds")
                     st.write("**Inactive customers (no orders in 30 days):**", adv['inactive_customers'])
                     st.write("**Days with Nett >2 SD below mean:**", [d.strftime('%Y-%m-%d') for d in adv['low_days']])
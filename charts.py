@@ -6,6 +6,7 @@ import plotly.graph_objects as go
 import folium
 from folium.plugins import MarkerCluster
 import pandas as pd
+import numpy as np
 import streamlit as st
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
@@ -13,24 +14,46 @@ import pickle
 import os
 import logging
 import re
+import threading
 from typing import Optional
+from metrics import daily_aggregates
+
+_POSTCODE_RE = re.compile(r"([A-Z]{1,2}[0-9][0-9A-Z]? ?[0-9][A-Z]{2})", re.IGNORECASE)
 
 def extract_uk_postcode(address: str) -> Optional[str]:
     """Extract the UK postcode from an address string."""
     if not isinstance(address, str):
         return None
-    match = re.search(r"([A-Z]{1,2}[0-9][0-9A-Z]? ?[0-9][A-Z]{2})", address.upper())
+    match = _POSTCODE_RE.search(address)
     if match:
-        return match.group(1)
+        pc = match.group(1).upper().replace(' ', '')
+        return pc[:-3] + ' ' + pc[-3:]
     return None
 
-def line_chart(df: pd.DataFrame, ma_col: Optional[int] = None, freq: str = 'D') -> go.Figure:
-    """Line chart of Nett by date with optional moving average overlay. freq: 'D', 'W', 'M'"""
+def _normalise_postcodes(postcodes: pd.Series) -> pd.Series:
+    """Upper-case "OUTWARD INWARD" form, e.g. 'm13ab' -> 'M1 3AB', so keys match the postcode table and cache.
+    The inward code is always the last three characters."""
+    postcodes = postcodes.str.upper().str.replace(' ', '', regex=False)
+    return postcodes.str[:-3] + ' ' + postcodes.str[-3:]
+
+def extract_uk_postcode_vec(addresses: pd.Series) -> pd.Series:
+    """Vectorised extract_uk_postcode: one regex pass over the whole Address column.
+    For a categorical column the regex only runs over the distinct addresses."""
+    if isinstance(addresses.dtype, pd.CategoricalDtype):
+        found = _normalise_postcodes(pd.Series(addresses.cat.categories).astype('string').str.extract(_POSTCODE_RE, expand=False))
+        # Trailing NaN so missing addresses (code -1) map to no postcode
+        lookup = np.append(found.to_numpy(dtype=object, na_value=np.nan), np.nan)
+        return pd.Series(lookup[addresses.cat.codes.to_numpy()], index=addresses.index, dtype=object)
+    return _normalise_postcodes(addresses.astype('string').str.extract(_POSTCODE_RE, expand=False))
+
+def line_chart(df: Optional[pd.DataFrame], ma_col: Optional[int] = None, freq: str = 'D', aggregates: Optional[pd.DataFrame] = None) -> go.Figure:
+    """Line chart of Nett by date with optional moving average overlay. freq: 'D', 'W', 'M'.
+    aggregates: output of daily_aggregates(df); when given, df is not read and may be None."""
     freq = 'ME' if freq == 'M' else freq
-    df = df.copy()
-    df = df[df['Entered'].notna()]
-    df = df.set_index('Entered').sort_index()
-    grouped = df['Nett'].resample(freq).sum()
+    if aggregates is None:
+        aggregates = daily_aggregates(df)
+    nett = aggregates.loc[aggregates.index.notna(), 'Nett']
+    grouped = nett.resample(freq).sum()
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=grouped.index, y=grouped.values, mode='lines', name='Nett'))
     if ma_col is not None:
@@ -41,7 +64,7 @@ def line_chart(df: pd.DataFrame, ma_col: Optional[int] = None, freq: str = 'D')
 
 def bar_chart(df: pd.DataFrame, by: str, value: str = 'Nett', top_n: int = 10) -> px.bar:
     """Bar chart for top N breakdowns by value."""
-    grouped = df.groupby(by)[value].sum()
+    grouped = df.groupby(by, observed=True, sort=False)[value].sum()
     grouped = pd.to_numeric(grouped, errors='coerce')  # Ensure numeric dtype
     grouped = grouped.nlargest(top_n).reset_index()
     fig = px.bar(grouped, x=by, y=value, title=f'Top {top_n} {by} by {value}', labels={by: by, value: value})
@@ -49,66 +72,139 @@ def bar_chart(df: pd.DataFrame, by: str, value: str = 'Nett', top_n: int = 10) -
 
 def heatmap_chart(df: pd.DataFrame) -> px.imshow:
     """Heatmap of Route vs O/T sales (sum Nett)."""
-    pivot = df.pivot_table(index='Route', columns='O/T', values='Nett', aggfunc='sum', fill_value=0, observed=False)
+    pivot = df.pivot_table(index='Route', columns='O/T', values='Nett', aggfunc='sum', fill_value=0, observed=True)
     pivot = pivot.infer_objects(copy=False)  # Remove FutureWarning about downcasting
     fig = px.imshow(pivot, labels=dict(x='O/T', y='Route', color='Nett'), title='Route vs O/T Sales Heatmap')
     return fig
 
 def pie_chart(df: pd.DataFrame) -> px.pie:
     """Pie chart of sales share by O/T."""
-    grouped = df.groupby('O/T')['Nett'].sum().reset_index()
+    grouped = df.groupby('O/T', observed=True)['Nett'].sum().reset_index()
     fig = px.pie(grouped, names='O/T', values='Nett', title='Sales Share by O/T')
     return fig
 
-def map_view(df: pd.DataFrame, only_cached: bool = True, top_n: int = 100) -> Optional[folium.Map]:
-    """Map sales by postcode area or post-town if possible, colour-scale by Nett sum. Handles geocoding errors and caches results. Only uses cached postcodes if only_cached=True. Limits to top_n postcodes."""
-    from config import GEO_CACHE_FILE
+_LEGACY_GEO_CACHE_FILE = 'geocode_cache_postcode.pkl'
+
+def _empty_geo_frame() -> pd.DataFrame:
+    """Empty Postcode/lat/lon frame with the same dtypes as a populated one."""
+    return pd.DataFrame({'Postcode': pd.Series(dtype=object), 'lat': pd.Series(dtype='float64'), 'lon': pd.Series(dtype='float64')})
+
+def _save_geocode_cache(cache: pd.DataFrame, cache_file: str) -> None:
+    """Write the geocode cache to a temp file, then rename it over cache_file, so a concurrent
+    render never reads a half-written file. Failures are logged, not raised."""
+    try:
+        tmp_path = f"{cache_file}.{threading.get_ident()}.part"
+        cache.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_file)
+    except Exception as e:
+        logging.warning(f"Could not write geocode cache '{cache_file}': {e}")
+
+def _load_geocode_cache(cache_file: str) -> pd.DataFrame:
+    """Geocode cache as a Postcode/lat/lon frame (NaN lat/lon marks a failed lookup).
+    The legacy pickled {postcode: (lat, lon)} dict is converted to cache_file the first time it is
+    read, so it is only unpickled once. Keys are normalised like extract_uk_postcode_vec, keeping a
+    geocoded row over a failed one. An unreadable cache_file is logged and treated as empty."""
+    if os.path.exists(cache_file):
+        try:
+            cache = pd.read_parquet(cache_file, columns=['Postcode', 'lat', 'lon'])
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable geocode cache '{cache_file}': {e}")
+            return _empty_geo_frame()
+    elif os.path.exists(_LEGACY_GEO_CACHE_FILE):
+        with open(_LEGACY_GEO_CACHE_FILE, "rb") as f:
+            postcode_map = pickle.load(f)
+        cache = pd.DataFrame(
+            [(pc, lat, lon) for pc, (lat, lon) in postcode_map.items()], columns=['Postcode', 'lat', 'lon']
+        ).astype({'lat': 'float64', 'lon': 'float64'})
+    else:
+        return _empty_geo_frame()
+    cache['Postcode'] = _normalise_postcodes(cache['Postcode'].astype(str))
+    cache = cache.sort_values('lat', na_position='last').drop_duplicates('Postcode')
+    if not os.path.exists(cache_file):
+        _save_geocode_cache(cache, cache_file)
+    return cache
+
+def _lookup_local_postcodes(postcodes: np.ndarray, table_file: str) -> pd.DataFrame:
+    """Coordinates for postcodes found in the local UK postcode table (Postcode, lat, lon Parquet,
+    e.g. built from the ONS Postcode Directory with upper-case "OUTWARD INWARD" postcodes).
+    Only the requested rows are read. Returns an empty frame if the table is not installed."""
+    if not os.path.exists(table_file) or len(postcodes) == 0:
+        return _empty_geo_frame()
+    try:
+        return pd.read_parquet(table_file, columns=['Postcode', 'lat', 'lon'],
+                               filters=[('Postcode', 'in', list(postcodes))]).dropna(subset=['lat', 'lon'])
+    except Exception as e:
+        logging.warning(f"Could not read local postcode table '{table_file}': {e}")
+        return _empty_geo_frame()
+
+def map_view(df: pd.DataFrame, only_cached: bool = True, top_n: int = 100, postcodes: Optional[pd.Series] = None) -> Optional[folium.Map]:
+    """Map sales by postcode area or post-town if possible, colour-scale by Nett sum. Handles geocoding errors and caches results. Only uses cached postcodes if only_cached=True. Limits to top_n postcodes.
+    postcodes: extract_uk_postcode_vec(df['Address']), if the caller already has it."""
+    from config import GEO_CACHE_FILE, UK_POSTCODES_FILE
 
-    df = df.copy()
     if 'Address' not in df.columns or df['Address'].isnull().all():
         st.warning("No address data available for mapping.")
         return None
-    df['Postcode'] = df['Address'].apply(extract_uk_postcode)
+    # Only the columns the map needs, instead of copying the whole frame
+    df = df[['Nett', 'Order', 'Address', 'Name']].assign(
+        Postcode=postcodes if postcodes is not None else extract_uk_postcode_vec(df['Address'])
+    )
     postcodes = df['Postcode'].dropna().unique()
     cache_file = GEO_CACHE_FILE
-    if os.path.exists(cache_file):
-        with open(cache_file, "rb") as f:
-            postcode_map = pickle.load(f)
-    else:
-        postcode_map = {}
-    updated = False
-    geolocator = Nominatim(user_agent="sales_dashboard", timeout=10)
-    geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1, max_retries=2, error_wait_seconds=2)
-    if not only_cached:
-        for pc in postcodes:
-            if pc not in postcode_map:
-                try:
-                    location = geocode(pc + ", UK")
-                    if location:
-                        postcode_map[pc] = (location.latitude, location.longitude)
-                    else:
-                        postcode_map[pc] = (None, None)
-                except Exception as e:
-                    postcode_map[pc] = (None, None)
-                    logging.warning(f"Geocoding failed for postcode '{pc}': {e}")
-                updated = True
-        if updated:
-            with open(cache_file, "wb") as f:
-                pickle.dump(postcode_map, f)
-    df['lat'] = df['Postcode'].map(lambda x: postcode_map.get(x, (None, None))[0])
-    df['lon'] = df['Postcode'].map(lambda x: postcode_map.get(x, (None, None))[1])
+    cache = _load_geocode_cache(cache_file)
+    # The local postcode table takes precedence; the geocode cache covers the rest
+    local = _lookup_local_postcodes(postcodes, UK_POSTCODES_FILE)
+    known = pd.concat([local, cache[~cache['Postcode'].isin(local['Postcode'])]], ignore_index=True)
+    unknown = postcodes[~pd.Index(postcodes).isin(known['Postcode'])]
+    # Nominatim (1 request/s) is only a fallback for postcodes missing from both
+    if not only_cached and len(unknown):
+        geolocator = Nominatim(user_agent="sales_dashboard", timeout=10)
+        geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1, max_retries=2, error_wait_seconds=2)
+        new_rows = []
+        for pc in unknown:
+            try:
+                location = geocode(pc + ", UK")
+                if location:
+                    new_rows.append((pc, location.latitude, location.longitude))
+                else:
+                    new_rows.append((pc, np.nan, np.nan))
+            except Exception as e:
+                new_rows.append((pc, np.nan, np.nan))
+                logging.warning(f"Geocoding failed for postcode '{pc}': {e}")
+        if new_rows:
+            new_rows = pd.DataFrame(new_rows, columns=['Postcode', 'lat', 'lon'])
+            cache = pd.concat([cache, new_rows], ignore_index=True)
+            _save_geocode_cache(cache, cache_file)
+            known = pd.concat([known, new_rows], ignore_index=True)
+    df = df.merge(known, on='Postcode', how='inner')
     df = df[df['lat'].notna() & df['lon'].notna()]
     if df.empty:
         st.warning("No geocoded postcodes available for mapping.")
         return None
-    agg = df.groupby(['Postcode', 'lat', 'lon']).agg({
-        'Nett': 'sum',
-        'Order': 'count',
-        'Address': 'first',
-        'Name': lambda x: ', '.join(sorted(set(x.dropna())))
-    }).reset_index()
-    agg['Nett'] = pd.to_numeric(agg['Nett'], errors='coerce')  # Ensure numeric dtype
+    # Nett sum and Order count per postcode via bincount on the category codes; the string
+    # columns (Address, Name) are then only aggregated for the top_n postcodes that are drawn
+    postcode_cat = df['Postcode'].astype('category')
+    codes = postcode_cat.cat.codes.to_numpy()
+    n_postcodes = len(postcode_cat.cat.categories)
+    agg = pd.DataFrame({
+        'Postcode': postcode_cat.cat.categories,
+        'Nett': np.bincount(codes, weights=df['Nett'].to_numpy(dtype=np.float64, na_value=0), minlength=n_postcodes),
+        'Order': np.bincount(codes, weights=df['Order'].notna().to_numpy(), minlength=n_postcodes).astype(np.int64),
+    })
     agg = agg.nlargest(top_n, 'Nett')
+    top = df[np.isin(codes, agg.index.to_numpy())]
+    # lat/lon come from the postcode and the postcode from the address, so the first row of
+    # each postcode is a valid sample for all three
+    sample = top.drop_duplicates('Postcode').set_index('Postcode')[['lat', 'lon', 'Address']]
+    # Distinct names per postcode in one hash pass, sorted, then joined per group
+    names = (top[['Postcode', 'Name']].dropna(subset=['Name'])
+             .drop_duplicates()
+             .astype({'Name': str})
+             .sort_values('Name')
+             .groupby('Postcode', sort=False)['Name']
+             .agg(', '.join))
+    agg = agg.join(sample, on='Postcode').join(names, on='Postcode')
+    agg['Name'] = agg['Name'].fillna('')
     m = folium.Map(location=[df['lat'].mean(), df['lon'].mean()], zoom_start=6)
     marker_cluster = MarkerCluster().add_to(m)
     for _, row in agg.iterrows():
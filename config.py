@@ -4,7 +4,13 @@ ALERT_THRESHOLD = 0.8  # 80% threshold for alerts
 FORECAST_DAYS = 30
 DATE_FORMAT = '%Y-%m-%d'
 LOG_FILE = 'dashboard.log'
-GEO_CACHE_FILE = 'geocode_cache_postcode.pkl'  # Path for geocode cache file
+GEO_CACHE_FILE = 'geocode_cache_postcode.parquet'  # Path for geocode cache file (Postcode, lat, lon)
+UK_POSTCODES_FILE = 'postcodes_uk.parquet'  # Optional local postcode table (Postcode, lat, lon), checked before geocoding
+UPLOAD_CACHE_DIR = '.upload_cache'  # Uploaded files, stored once per content hash
+UPLOAD_CACHE_MAX_AGE_DAYS = 30  # Stored uploads and their prepared-data sidecars older than this are deleted
+# bcrypt work factor (2**rounds iterations). 10 is ~4x faster than the library default of 12;
+# raise it if the dashboard is exposed beyond an internal network. Existing hashes keep their own cost.
+BCRYPT_ROUNDS = 10
 # Centralized column names for maintainability
 REQUIRED_COLUMNS = [
     'Order', 'Account', 'Name', 'Address', 'Description', 'Type', 'Entered', 'Sent',
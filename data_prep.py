@@ -3,41 +3,46 @@ data_prep.py: Data cleaning and feature engineering for sales dashboard.
 """
 import pandas as pd
 import logging
-import streamlit as st
 import time
 import numpy as np
-from config import NUMERIC_COLS, CATEGORICAL_COLS
+from config import NUMERIC_COLS
+
+# Bump whenever prepare_data's output (columns, dtypes, ordering) changes, so prepared-data
+# caches written by an older version are ignored
+PREPARE_VERSION = 2
 
-@st.cache_data(show_spinner=False)
 def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
     """Clean, transform, and add features to the sales data. Do not deduplicate by Order. Include all rows regardless of Nett value."""
     t0 = time.time()
     # Parse Entered and Sent as datetime (UK format: dayfirst)
-    date_formats = ["%d/%m/%Y", "%d/%m/%Y %H:%M:%S"]
+    # The format is picked from the first non-null value, so a clean column is parsed in one pass;
+    # values that do not match it fall back to a lenient dayfirst parse
     for col in ['Entered', 'Sent']:
-        parsed = None
-        for fmt in date_formats:
-            try:
-                parsed = pd.to_datetime(df[col], format=fmt, errors='raise')
-                df[col] = parsed
-                break
-            except Exception:
-                continue
-        if parsed is None:
-            df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True)
-    # Convert numeric columns to float
+        s = df[col]
+        first = s.first_valid_index()
+        sample = str(s[first]) if first is not None else ''
+        fmt = "%d/%m/%Y %H:%M:%S" if ' ' in sample.strip() else "%d/%m/%Y"
+        parsed = pd.to_datetime(s, format=fmt, errors='coerce')
+        unparsed = parsed.isna() & s.notna()
+        if unparsed.any():
+            parsed[unparsed] = pd.to_datetime(s[unparsed], errors='coerce', dayfirst=True)
+        df[col] = parsed
+    # Currency columns stay float64 (float32 visibly rounds pence off totals);
+    # Qty is downcast to the narrowest integer type when it has no gaps
     for col in NUMERIC_COLS:
-        df.loc[:, col] = pd.to_numeric(df[col], errors='coerce')
-    # Convert categorical columns to category
-    for col in CATEGORICAL_COLS:
-        if col in df.columns:
-            df.loc[:, col] = df[col].astype('category')
+        df[col] = pd.to_numeric(df[col], errors='coerce', downcast='integer' if col == 'Qty' else None)
     # Add Gross_Margin and Margin_%
     df.loc[:, 'Gross_Margin'] = df['Nett'] - df['Cost']
-    # Avoid division by zero for Margin_% using masking
-    df['Margin_%'] = np.nan
-    mask = df['Nett'] != 0
-    df.loc[mask, 'Margin_%'] = np.round(df.loc[mask, 'Gross_Margin'] / df.loc[mask, 'Nett'] * 100, 1)
+    # Margin_% in one NumPy pass; rows with zero Nett are left as NaN instead of dividing by zero
+    nett = df['Nett'].to_numpy()
+    gm = df['Gross_Margin'].to_numpy()
+    margin = np.full(nett.shape, np.nan, dtype=np.float64)
+    np.divide(gm, nett, out=margin, where=nett != 0)
+    np.multiply(margin, 100, out=margin)
+    np.round(margin, 1, out=margin)
+    df['Margin_%'] = margin
+    # Stable sort by Entered once here (undated rows last) so downstream date work sees ordered rows
+    df = df.sort_values('Entered', kind='mergesort', na_position='last').reset_index(drop=True)
     prep_time = time.time() - t0
     logging.info(f"Data preparation completed in {prep_time:.2f} seconds")
     return df
\ No newline at end of file
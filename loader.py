@@ -1,23 +1,31 @@
 """
 loader.py: Handles file selection and loading for sales dashboard.
 """
+import io
 import os
 import pandas as pd
 import logging
-import streamlit as st
 import time
-from config import DATA_PATH
+from typing import BinaryIO, Optional, Union
+from config import DATA_PATH, CATEGORICAL_COLS
 
 REQUIRED_COLUMNS = [
     'Order', 'Account', 'Name', 'Address', 'Description', 'Type', 'Entered', 'Sent',
     'Qty', 'List', 'Nett', 'Cost', 'Route', 'Reference', "P'list", 'FOC', 'O/T', 'Promo'
 ]
 
-@st.cache_data(show_spinner=False)
-def load_data(file_path):
-    """Load Excel or CSV file and validate columns. Returns DataFrame or raises Exception."""
+def load_data(file_path: Union[str, BinaryIO, bytes], ext: Optional[str] = None):
+    """Load Excel or CSV file and validate columns. Returns DataFrame or raises Exception.
+    file_path may also be raw bytes or a binary file-like object, read in memory without a tempfile;
+    ext ('.xlsx', '.xls', '.csv') is then required unless the object has a name.
+    Not cached: app.py caches the prepared frame (in memory and as a Parquet sidecar), so the
+    file is only parsed when both of those miss."""
     t0 = time.time()
-    ext = os.path.splitext(file_path)[1].lower()
+    if isinstance(file_path, bytes):
+        file_path = io.BytesIO(file_path)
+    if ext is None:
+        ext = os.path.splitext(file_path if isinstance(file_path, str) else getattr(file_path, 'name', ''))[1]
+    ext = ext.lower()
     usecols = [
         'Order', 'Account', 'Name', 'Address', 'Description', 'Type', 'Entered', 'Sent',
         'Qty', 'List', 'Nett', 'Cost', 'Route', 'Reference', "P'list", 'FOC', 'O/T', 'Promo'
@@ -29,6 +37,8 @@ def load_data(file_path):
             try:
                 df = pd.read_csv(file_path, encoding='utf-8', usecols=usecols, dtype=str)
             except UnicodeDecodeError:
+                if not isinstance(file_path, str):
+                    file_path.seek(0)
                 df = pd.read_csv(file_path, encoding='cp1252', usecols=usecols, dtype=str)
         else:
             raise ValueError('Unsupported file type. Please upload .xlsx, .xls, or .csv')
@@ -42,5 +52,8 @@ def load_data(file_path):
         msg = f"Missing required columns: {', '.join(missing)}"
         logging.error(msg)
         raise ValueError(msg)
-    # Remove dtype conversions here; handled in data_prep.py
+    # Repeated strings become integer codes; numeric and date parsing is handled in data_prep.py
+    for col in CATEGORICAL_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
     return df
\ No newline at end of file
@@ -6,30 +6,55 @@ import numpy as np
 import holidays
 import streamlit as st
 import logging
-from typing import Dict, Any
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from typing import Dict, Any, Optional
 from functools import lru_cache
 
 
-@lru_cache(maxsize=1)
-def get_uk_holidays():
-    return holidays.country_holidays('GB')
+@lru_cache(maxsize=8)
+def get_uk_holiday_dates(first_year: int, last_year: int) -> np.ndarray:
+    """Sorted UK bank holidays for the given year range as a datetime64[D] array, for np.busday_count."""
+    uk_holidays = holidays.country_holidays('GB', years=range(first_year, last_year + 1))
+    return np.array(sorted(uk_holidays.keys()), dtype='datetime64[D]')
 
 
-def compute_kpis(df: pd.DataFrame) -> Dict[str, Any]:
-    """Calculate top-level KPIs for dashboard cards."""
-    total_nett = df['Nett'].sum()
-    total_orders = pd.Series(df['Order'].unique()).nunique()
-    total_units = df['Qty'].sum()
+@st.cache_data(show_spinner=False)
+def daily_aggregates(df: pd.DataFrame) -> pd.DataFrame:
+    """Per-day Nett, unique orders, units and margin sum/count in a single groupby pass.
+    Rows without an Entered date are kept under a NaT index entry so totals still add up."""
+    days = df['Entered'].dt.floor('D').rename('Entered')
+    return df.groupby(days, sort=True, dropna=False).agg(
+        Nett=('Nett', 'sum'),
+        Orders=('Order', 'nunique'),
+        Units=('Qty', 'sum'),
+        Margin_sum=('Margin_%', 'sum'),
+        Margin_count=('Margin_%', 'count'),
+    )
+
+def compute_kpis(df: pd.DataFrame, aggregates: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
+    """Calculate top-level KPIs for dashboard cards. aggregates: output of daily_aggregates(df), if already computed."""
+    if aggregates is None:
+        aggregates = daily_aggregates(df)
+    total_nett = aggregates['Nett'].sum()
+    total_orders = df['Order'].nunique()
+    total_units = aggregates['Units'].sum()
     avg_order_value = total_nett / total_orders if total_orders else 0
-    avg_margin = df['Margin_%'].mean() if not df.empty else 0
-    uk_holidays = get_uk_holidays()
-    def business_days(row):
-        if pd.isnull(row['Entered']) or pd.isnull(row['Sent']):
-            return None
-        days = pd.bdate_range(row['Entered'], row['Sent'], holidays=uk_holidays)
-        return len(days) - 1 if len(days) > 0 else 0
-    turnaround_days = df.apply(business_days, axis=1)
-    avg_turnaround = turnaround_days.dropna().mean() if not turnaround_days.dropna().empty else 0
+    margin_count = aggregates['Margin_count'].sum()
+    avg_margin = aggregates['Margin_sum'].sum() / margin_count if margin_count else 0
+    # Business days from Entered to Sent, excluding UK holidays: the number of business days in
+    # [Entered, Sent] minus one, floored at zero. busday_count is half-open, hence Sent + 1 day.
+    valid = (df['Entered'].notna() & df['Sent'].notna()).to_numpy()
+    if valid.any():
+        entered = df['Entered'].to_numpy()[valid].astype('datetime64[D]')
+        sent = df['Sent'].to_numpy()[valid].astype('datetime64[D]')
+        uk_holidays = get_uk_holiday_dates(int(entered.min().astype(object).year), int(sent.max().astype(object).year))
+        turnaround_days = np.maximum(np.busday_count(entered, sent + np.timedelta64(1, 'D'), holidays=uk_holidays) - 1, 0)
+        avg_turnaround = turnaround_days.mean()
+    else:
+        avg_turnaround = 0
     return {
         'Total Nett Sales': total_nett,
         'Total Orders': total_orders,
@@ -39,14 +64,40 @@ def compute_kpis(df: pd.DataFrame) -> Dict[str, Any]:
         'Average Turnaround': avg_turnaround
     }
 
-@st.cache_data(show_spinner=False)
-def compute_advanced_metrics(df: pd.DataFrame, forecast_days: int = 30) -> Dict[str, Any]:
-    """Calculate moving averages, customer inactivity, forecast, and anomaly detection. Also forecasts unique order count per day."""
+def _history_key(history: pd.DataFrame) -> str:
+    """Content hash of a ds/y history frame, used to key fitted models."""
+    return hashlib.sha1(pd.util.hash_pandas_object(history, index=False).values.tobytes()).hexdigest()
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _fit_prophet(history_key: str, _history: pd.DataFrame):
+    """Fit a Prophet model on a ds/y history. Cached on history_key (_history is not hashed),
+    so changing only the forecast horizon reuses the fitted model."""
     from prophet import Prophet
+    model = Prophet(interval_width=0.95, daily_seasonality=True)
+    model.fit(_history)
+    return model
+
+def _forecast(model, days: int) -> pd.DataFrame:
+    """Predict the fitted history plus the next `days` days."""
+    future = model.make_future_dataframe(periods=days)
+    return model.predict(future)
+
+def _fit_and_forecast(history: pd.DataFrame, days: int) -> pd.DataFrame:
+    """Fit (or reuse) the model for history and forecast `days` ahead, indexed by ds."""
+    model = _fit_prophet(_history_key(history), history)
+    return _forecast(model, days).set_index('ds')
+
+@st.cache_data(show_spinner=False)
+def compute_advanced_metrics(df: pd.DataFrame, forecast_days: int = 30, aggregates: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
+    """Calculate moving averages, customer inactivity, forecast, and anomaly detection. Also forecasts unique order count per day.
+    aggregates: output of daily_aggregates(df), if already computed."""
     from datetime import timedelta
     results = {}
+    if aggregates is None:
+        aggregates = daily_aggregates(df)
+    dated = aggregates[aggregates.index.notna()]
     # 7-day moving average of daily Nett
-    daily = df.groupby('Entered')['Nett'].sum().sort_index()
+    daily = dated['Nett']
     ma7 = daily.rolling(7).mean()
     results['7d_ma'] = ma7
     # Customers with no orders in past 30 days
@@ -57,22 +108,19 @@ def compute_advanced_metrics(df: pd.DataFrame, forecast_days: int = 30) -> Dict[
     results['inactive_customers'] = inactive_customers
     # Prophet forecast of Nett for next forecast_days with confidence intervals
     forecast_df = pd.DataFrame({'ds': daily.index, 'y': daily.values})
-    daily_orders = df.groupby('Entered')['Order'].nunique().sort_index()
+    daily_orders = dated['Orders']
     forecast_orders_df = pd.DataFrame({'ds': daily_orders.index, 'y': daily_orders.values})
     if len(forecast_df) > 10 and len(forecast_orders_df) > 10:
-        m_nett = Prophet(interval_width=0.95, daily_seasonality=True)
-        m_nett.fit(forecast_df)
-        future_nett = m_nett.make_future_dataframe(periods=forecast_days)
-        forecast_nett = m_nett.predict(future_nett)
-        forecast_nett.set_index('ds', inplace=True)
+        # The two fits are independent and Stan runs out of process, so do them side by side.
+        # Workers get the script run context so the cached _fit_prophet behaves as on the main thread.
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(max_workers=2, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as ex:
+            fut_nett = ex.submit(_fit_and_forecast, forecast_df, forecast_days)
+            fut_orders = ex.submit(_fit_and_forecast, forecast_orders_df, forecast_days)
+            forecast_nett, forecast_orders = fut_nett.result(), fut_orders.result()
         results['forecast'] = forecast_nett['yhat']
         results['forecast_lower'] = forecast_nett['yhat_lower']
         results['forecast_upper'] = forecast_nett['yhat_upper']
-        m_orders = Prophet(interval_width=0.95, daily_seasonality=True)
-        m_orders.fit(forecast_orders_df)
-        future_orders = m_orders.make_future_dataframe(periods=forecast_days)
-        forecast_orders = m_orders.predict(future_orders)
-        forecast_orders.set_index('ds', inplace=True)
         results['forecast_orders'] = forecast_orders['yhat']
     else:
         results['forecast'] = pd.Series(dtype=float)
@@ -84,4 +132,52 @@ def compute_advanced_metrics(df: pd.DataFrame, forecast_days: int = 30) -> Dict[
     low_days = daily[daily < mean - 2 * std].index.tolist()
     results['low_days'] = low_days
     logging.info("Advanced metrics calculated.")
-    return results
\ No newline at end of file
+    return results
+
+
+# Expander tables. Keyed on a cheap filter_key tuple (file, date range, Name, O/T) rather than
+# hashing the frame; the leading underscore tells Streamlit not to hash _df.
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_yoy(filter_key: tuple, _df: pd.DataFrame) -> pd.DataFrame:
+    """Month x Year pivot of Nett for the year-over-year chart."""
+    entered = _df['Entered'].dt
+    yoy_grouped = _df.groupby([entered.year.rename('Year'), entered.month.rename('Month')], sort=False)['Nett'].sum().reset_index()
+    return yoy_grouped.pivot(index='Month', columns='Year', values='Nett').sort_index()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_segmentation(filter_key: tuple, _df: pd.DataFrame) -> pd.DataFrame:
+    """Per-customer Nett and order count with a quartile Segment label."""
+    seg_df = _df.groupby('Name', observed=True).agg({
+        'Nett': 'sum',
+        'Order': 'nunique'
+    }).rename(columns={'Order': 'Order Count'}).reset_index()
+    # Quartile labels as in pd.qcut(..., 4): right-closed bins, so a value equal to a cut point
+    # falls in the lower segment (searchsorted side='left')
+    nett = seg_df['Nett'].to_numpy(dtype=np.float64)
+    cuts = np.quantile(nett, [0.25, 0.5, 0.75]) if nett.size else np.empty(0)
+    seg_df['Segment'] = pd.Categorical.from_codes(
+        np.searchsorted(cuts, nett, side='left'), ['Low', 'Mid-Low', 'Mid-High', 'High'], ordered=True
+    )
+    return seg_df
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_churn(filter_key: tuple, _df: pd.DataFrame, days: int = 90) -> pd.DataFrame:
+    """Customers whose last order is more than `days` before the latest order in _df."""
+    last_date = _df['Entered'].max()
+    churn_df = _df.groupby('Name', observed=True)['Entered'].max().reset_index()
+    churn_df['Days Since Last Order'] = (last_date - churn_df['Entered']).dt.days
+    return churn_df[churn_df['Days Since Last Order'] > days]
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_product_summary(filter_key: tuple, _df: pd.DataFrame, top_n: int = 10, trend_n: int = 5):
+    """Top and bottom products by Nett, plus the daily Nett trend of the top trend_n products."""
+    prod_df = _df.groupby('Description', observed=True, sort=False).agg({'Nett': 'sum', 'Order': 'nunique'}).reset_index()
+    prod_df['Nett'] = pd.to_numeric(prod_df['Nett'], errors='coerce')  # Ensure numeric dtype
+    top_products = prod_df.nlargest(top_n, 'Nett')
+    bottom_products = prod_df.nsmallest(top_n, 'Nett')
+    # Match on category codes: Description is categorical in both frames
+    top_codes = _df['Description'].cat.categories.get_indexer(top_products['Description'].head(trend_n))
+    prod_trend = _df[np.isin(_df['Description'].cat.codes.to_numpy(), top_codes)]
+    prod_trend = prod_trend.groupby(['Entered', 'Description'], observed=True)['Nett'].sum().reset_index()
+    return top_products, bottom_products, prod_trend